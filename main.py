@@ -1,6 +1,14 @@
 import bluetooth
-from machine import Pin
+from machine import Pin, Timer
 import time
+import array
+import asyncio
+import binascii
+import micropython
+from micropython import const
+
+# Per-event logging; printing blocks on the UART, so it is compiled out when 0
+_DEBUG = const(0)
 
 # Setup pins
 led = Pin("LED", Pin.OUT)
@@ -13,7 +21,8 @@ ble = bluetooth.BLE()
 ble.active(True)
 
 # Device tracking
-connected_devices = {}
+connected_handles = []  # Connection handles, in connect order
+connected_addrs = []  # Address string for each entry in connected_handles
 rssi_blink_active = False
 current_rssi = -60  # Default moderate signal
 
@@ -32,208 +41,372 @@ service_def = (
 ((led_handle,),) = ble.gatts_register_services((service_def,))
 ble.gatts_write(led_handle, b'ready')
 
-def rssi_to_blink_interval(rssi):
-    """Convert RSSI to blink interval in milliseconds"""
-    # RSSI thresholds with precise blink intervals
-    rssi_map = {
-        -30: 25,    # Excellent signal - very fast blink
-        -35: 50,    # Very strong signal
-        -40: 75,    # Strong signal
-        -45: 100,   # Good signal
-        -50: 150,   # Moderate signal
-        -60: 300,   # Fair signal
-        -70: 600,   # Weak signal
-        -80: 1000,  # Poor signal
-        -90: 1500   # Very poor signal
-    }
-    
-    # Find the appropriate interval based on RSSI value
-    # Use the threshold that the RSSI is greater than or equal to
-    for threshold in sorted(rssi_map.keys(), reverse=True):
-        if rssi >= threshold:
-            return rssi_map[threshold]
+# Advertising interval (gap_advertise takes microseconds) and payload
+# (constant, so build it once)
+_ADV_INTERVAL_US = const(100_000)  # 100ms = discoverable
+ADV_NAME = b'Gate'  # Device name for pairing
+_SERVICE_BYTES = bytes(SERVICE_UUID)
+_ADV_DATA = (
+    bytes([2, 0x01, 0x06])  # Flags - General discoverable, BR/EDR not supported
+    + bytes([len(ADV_NAME) + 1, 0x09]) + ADV_NAME  # Complete Local Name
+    + bytes([len(_SERVICE_BYTES) + 1, 0x07]) + _SERVICE_BYTES  # Service UUID (128-bit)
+)
+
+# RSSI thresholds (dBm, strongest first) and their blink intervals in ms
+_RSSI_THRESHOLDS = (-30, -35, -40, -45, -50, -60, -70, -80, -90)
+_RSSI_INTERVALS = (25, 50, 75, 100, 150, 300, 600, 1000, 1500)
+
+def _blink_interval_for(rssi):
+    """Scan the RSSI thresholds for a blink interval (used to build the table)"""
+    # Use the first threshold that the RSSI is greater than or equal to
+    for i in range(9):
+        if rssi >= _RSSI_THRESHOLDS[i]:
+            return _RSSI_INTERVALS[i]
     
     # If RSSI is worse than -90, use slowest blink
     return 1500
 
+# Blink interval for every RSSI from 0 to -100 dBm, indexed by -rssi
+_BLINK_BY_NEG_RSSI = array.array('H', (_blink_interval_for(-i) for i in range(101)))
+
+@micropython.viper
+def rssi_to_blink_interval(rssi: int) -> int:
+    """Convert RSSI to blink interval in milliseconds"""
+    i = 0 - rssi
+    if i < 0:
+        i = 0
+    elif i > 100:
+        i = 100
+    table = ptr16(_BLINK_BY_NEG_RSSI)
+    return table[i]
+
+current_blink_interval_ms = rssi_to_blink_interval(current_rssi)
+
+# RSSI blinking runs from a soft timer whose callback only toggles the LED
+_blink_timer = Timer()
+
+def _blink_step(t):
+    """Toggle the LED, unless blinking was stopped after this was queued"""
+    if rssi_blink_active:
+        led.toggle()
+
+def _start_blink_timer():
+    """(Re)arm the blink timer with the current blink interval"""
+    _blink_timer.init(mode=Timer.PERIODIC, period=current_blink_interval_ms, callback=_blink_step)
+
 def update_rssi(new_rssi):
     """Update current RSSI value from Flutter app"""
-    global current_rssi
+    global current_rssi, current_blink_interval_ms
     current_rssi = new_rssi
-    print(f"📶 RSSI updated: {current_rssi} dBm")
+    interval_ms = rssi_to_blink_interval(new_rssi)
+    
+    # Only re-arm the timer on a real change, otherwise frequent updates
+    # would keep restarting the period before the LED ever toggles
+    if interval_ms != current_blink_interval_ms:
+        current_blink_interval_ms = interval_ms
+        if rssi_blink_active:
+            _start_blink_timer()
+    
+    if _DEBUG:
+        print(f"📶 RSSI updated: {current_rssi} dBm, Blink interval: {current_blink_interval_ms}ms")
 
 def start_rssi_monitoring():
     """Start RSSI-based LED blinking"""
     global rssi_blink_active
     rssi_blink_active = True
-    print("📶 Started RSSI monitoring and LED blinking")
+    cancel_welcome_sequence()
+    _start_blink_timer()
+    if _DEBUG:
+        print("📶 Started RSSI monitoring and LED blinking")
 
 def stop_rssi_monitoring():
     """Stop RSSI-based LED blinking"""
     global rssi_blink_active
     rssi_blink_active = False
+    cancel_welcome_sequence()
+    _blink_timer.deinit()
     led.off()
-    print("📶 Stopped RSSI monitoring")
-
-def update_rssi_blink():
-    """Update LED blinking based on current RSSI"""
-    if not rssi_blink_active:
-        return 400  # Default interval in ms
-    
-    interval_ms = rssi_to_blink_interval(current_rssi)
-    
-    # Just toggle the LED - don't use blocking sleep here
-    led.toggle()
-    
-    print(f"📶 RSSI: {current_rssi} dBm, Blink interval: {interval_ms}ms, LED: {'ON' if led.value() else 'OFF'}")
-    
-    return interval_ms
+    if _DEBUG:
+        print("📶 Stopped RSSI monitoring")
 
 def get_device_addr_string(addr_bytes):
     """Convert address bytes to string"""
-    return ':'.join(['%02x' % b for b in addr_bytes])
+    return binascii.hexlify(addr_bytes, ':').decode()
 
-def welcome_sequence():
-    """LED welcome sequence when device connects"""
-    print("🎯 Device connected - playing welcome sequence!")
+# Welcome sequence runs from a soft timer so it never blocks BLE handling
+_welcome_timer = Timer()
+_welcome_steps_left = 0
+
+def _welcome_step(t):
+    """Advance the welcome sequence by one LED change"""
+    global _welcome_steps_left
+    # Cancelled - deinit() can't unqueue a callback that was already scheduled
+    if _welcome_steps_left <= 0:
+        return
     
-    # LED welcome sequence
-    for i in range(5):
-        led.on()
-        time.sleep(0.15)
+    _welcome_steps_left -= 1
+    if _welcome_steps_left == 0:
         led.off()
-        time.sleep(0.1)
+        if _DEBUG:
+            print("✅ Welcome sequence completed")
+        return
     
-    print("✅ Welcome sequence completed")
+    # 150ms on, 100ms off - the LED is on whenever an even number of steps is left
+    led_on = _welcome_steps_left % 2 == 0
+    led.value(led_on)
+    _welcome_timer.init(mode=Timer.ONE_SHOT, period=150 if led_on else 100, callback=_welcome_step)
 
-def ble_handler(event, data):
-    global connected_devices
+def welcome_sequence():
+    """Start the LED welcome sequence when device connects (returns immediately)"""
+    global _welcome_steps_left
+    if _DEBUG:
+        print("🎯 Device connected - playing welcome sequence!")
     
+    # 5 on/off flashes = 10 LED changes
+    _welcome_steps_left = 10
+    led.on()
+    _welcome_timer.init(mode=Timer.ONE_SHOT, period=150, callback=_welcome_step)
+
+def cancel_welcome_sequence():
+    """Stop the welcome sequence so it can't override the LED"""
+    global _welcome_steps_left
+    _welcome_timer.deinit()
+    _welcome_steps_left = 0
+
+# Notification payloads
+_R_CONNECTED = b'connected'
+_R_ON = b'on'
+_R_OFF = b'off'
+_R_UNLOCKED = b'unlocked'
+_R_LOCKED = b'locked'
+_R_RSSI_START = b'rssi_started'
+_R_RSSI_STOP = b'rssi_stopped'
+_R_UNKNOWN = b'unknown'
+_R_RSSI_ERR = b'rssi_error'
+
+def cmd_on():
+    """Turn off RSSI blinking and turn LED on solid"""
+    stop_rssi_monitoring()
+    led.on()
+    return _R_ON
+
+def cmd_off():
+    """Turn off RSSI blinking and turn LED off"""
+    stop_rssi_monitoring()
+    led.off()
+    return _R_OFF
+
+def cmd_toggle():
+    """Turn off RSSI blinking and toggle LED"""
+    stop_rssi_monitoring()
+    led.toggle()
+    return _R_ON if led.value() else _R_OFF
+
+def cmd_unlock():
+    """Energise the gate relay"""
+    relay_pin.on()
+    return _R_UNLOCKED
+
+def cmd_lock():
+    """Release the gate relay"""
+    relay_pin.off()
+    return _R_LOCKED
+
+def cmd_start_rssi():
+    """Start RSSI monitoring mode"""
+    start_rssi_monitoring()
+    return _R_RSSI_START
+
+def cmd_stop_rssi():
+    """Stop RSSI monitoring mode"""
+    stop_rssi_monitoring()
+    return _R_RSSI_STOP
+
+# Command dispatch table (rssi:<value> is handled separately)
+_COMMANDS = {
+    '1': cmd_on,
+    'on': cmd_on,
+    '0': cmd_off,
+    'off': cmd_off,
+    'toggle': cmd_toggle,
+    'unlock': cmd_unlock,
+    'lock': cmd_lock,
+    'start_rssi': cmd_start_rssi,
+    'stop_rssi': cmd_stop_rssi,
+}
+
+def handle_rssi_value(text):
+    """Apply an RSSI value sent as rssi:<value> and return the reply"""
+    try:
+        rssi_value = int(text)
+        update_rssi(rssi_value)
+        return b'rssi_updated:%d' % rssi_value
+    except:
+        return _R_RSSI_ERR
+
+def handle_ble_event(event, data):
+    """Process a BLE event queued by ble_handler (runs outside IRQ context)"""
     if event == 1:  # Device connected
         conn_handle, addr_type, addr = data
         addr_str = get_device_addr_string(addr)
         
-        connected_devices[conn_handle] = {
-            'addr': addr_str,
-            'name': 'Phone'
-        }
+        connected_handles.append(conn_handle)
+        connected_addrs.append(addr_str)
+        
+        # No need to keep advertising while a phone is connected
+        ble.gap_advertise(None)
         
-        print(f"📱 Device connected: {addr_str}")
+        if _DEBUG:
+            print(f"📱 Device connected: {addr_str}")
         
         # Play welcome sequence
         welcome_sequence()
         
         # Send ready notification
         try:
-            ble.gatts_notify(conn_handle, led_handle, b'connected')
+            ble.gatts_notify(conn_handle, led_handle, _R_CONNECTED)
         except:
             pass
             
     elif event == 2:  # Device disconnected
         conn_handle, addr_type, addr = data
-        if conn_handle in connected_devices:
-            device_info = connected_devices[conn_handle]
-            print(f"📱 Device disconnected: {device_info['addr']}")
+        if conn_handle in connected_handles:
+            i = connected_handles.index(conn_handle)
+            if _DEBUG:
+                print(f"📱 Device disconnected: {connected_addrs[i]}")
             
-            # Stop RSSI monitoring when device disconnects
+            # Stop RSSI monitoring (and any welcome sequence) when device disconnects
             stop_rssi_monitoring()
             
-            del connected_devices[conn_handle]
+            del connected_handles[i]
+            del connected_addrs[i]
+        
+        # Become discoverable again
+        ble.gap_advertise(_ADV_INTERVAL_US, _ADV_DATA)
             
     elif event == 3:  # Data written
-        conn_handle, value_handle = data
+        conn_handle, value_handle, value = data
         
-        if conn_handle not in connected_devices:
+        if conn_handle not in connected_handles:
             return
-            
-        device_info = connected_devices[conn_handle]
         
         if value_handle == led_handle:
             # LED control
-            value = ble.gatts_read(led_handle)
-            command = value.decode('utf-8').strip().lower()
-            
-            print(f"📝 Command from {device_info['addr']}: {command}")
-            
-            if command in ['1', 'on']:
-                # Turn off RSSI blinking and turn LED on solid
-                stop_rssi_monitoring()
-                led.on()
-                status = 'on'
-            elif command in ['0', 'off']:
-                # Turn off RSSI blinking and turn LED off
-                stop_rssi_monitoring()
-                led.off()
-                status = 'off'
-            elif command == 'toggle':
-                # Turn off RSSI blinking and toggle LED
-                stop_rssi_monitoring()
-                led.toggle()
-                status = 'on' if led.value() else 'off'
-            elif command == 'unlock':
-                relay_pin.on()
-                status = 'unlocked'
-            elif command == 'lock':
-                relay_pin.off()
-                status = 'locked'
-            elif command == 'start_rssi':
-                # Start RSSI monitoring mode
-                start_rssi_monitoring()
-                status = 'rssi_started'
-            elif command == 'stop_rssi':
-                # Stop RSSI monitoring mode
-                stop_rssi_monitoring()
-                status = 'rssi_stopped'
-            elif command.startswith('rssi:'):
-                # Receive RSSI data from Flutter app
-                try:
-                    rssi_value = int(command.split(':')[1])
-                    update_rssi(rssi_value)
-                    status = f'rssi_updated:{rssi_value}'
-                except:
-                    status = 'rssi_error'
+            if value.startswith(b'rssi:'):
+                # Receive RSSI data from Flutter app (sent every second, so
+                # parse the raw bytes instead of decoding a command string)
+                reply = handle_rssi_value(value[5:])
             else:
-                status = 'unknown'
+                command = value.decode('utf-8').strip().lower()
+                
+                if _DEBUG:
+                    print(f"📝 Command from {connected_addrs[connected_handles.index(conn_handle)]}: {command}")
+                
+                handler = _COMMANDS.get(command)
+                if handler:
+                    reply = handler()
+                elif command.startswith('rssi:'):
+                    # e.g. typed as 'RSSI:-55' or with surrounding whitespace
+                    reply = handle_rssi_value(command[5:])
+                else:
+                    reply = _R_UNKNOWN
             
             # Send status back
             try:
-                ble.gatts_notify(conn_handle, led_handle, status.encode())
+                ble.gatts_notify(conn_handle, led_handle, reply)
             except:
                 pass
 
+# BLE events waiting for _drain, as (event, data) in a fixed-size ring.
+# Writes may not use the last CONN_EVENT_RESERVE slots, which are kept for
+# connect/disconnect events so those are never lost to a burst of writes.
+EVENT_QUEUE_SIZE = 8
+CONN_EVENT_RESERVE = 2
+_event_queue = [None] * EVENT_QUEUE_SIZE
+_event_head = 0
+_event_count = 0
+_drain_scheduled = False
+
+def _drain(_):
+    """Handle all queued BLE events"""
+    global _event_head, _event_count, _drain_scheduled
+    _drain_scheduled = False
+    
+    while _event_count:
+        event, data = _event_queue[_event_head]
+        _event_queue[_event_head] = None
+        _event_head = (_event_head + 1) % EVENT_QUEUE_SIZE
+        _event_count -= 1
+        handle_ble_event(event, data)
+
+def _schedule_drain():
+    """Schedule _drain unless it is already pending"""
+    global _drain_scheduled
+    if not _drain_scheduled:
+        try:
+            micropython.schedule(_drain, None)
+            _drain_scheduled = True
+        except RuntimeError:
+            pass  # Scheduler queue full - retried by the next event or status()
+
+def _evict_oldest_write():
+    """Drop the oldest queued write to make room, keeping the rest in order"""
+    global _event_count
+    for n in range(_event_count):
+        if _event_queue[(_event_head + n) % EVENT_QUEUE_SIZE][0] == 3:
+            # Shift the later events back over the evicted write
+            for m in range(n, _event_count - 1):
+                i = (_event_head + m) % EVENT_QUEUE_SIZE
+                _event_queue[i] = _event_queue[(i + 1) % EVENT_QUEUE_SIZE]
+            _event_count -= 1
+            _event_queue[(_event_head + _event_count) % EVENT_QUEUE_SIZE] = None
+            return True
+    return False
+
+def ble_handler(event, data):
+    """BLE IRQ: queue the event and leave the real work to _drain"""
+    global _event_count
+    
+    if event == 1 or event == 2:  # Connect/disconnect - addr is only valid during the IRQ
+        data = (data[0], data[1], bytes(data[2]))
+        if _event_count == EVENT_QUEUE_SIZE and not _evict_oldest_write():
+            # Only connection events are queued - handle them now, in order,
+            # rather than lose connection state
+            _drain(None)
+    elif event == 3:  # Data written - read now, a later write would overwrite it
+        if _event_count >= EVENT_QUEUE_SIZE - CONN_EVENT_RESERVE:
+            return  # Queue full - drop the write
+        data = (data[0], data[1], ble.gatts_read(data[1]))
+    else:
+        return
+    
+    _event_queue[(_event_head + _event_count) % EVENT_QUEUE_SIZE] = (event, data)
+    _event_count += 1
+    _schedule_drain()
+
 # Set event handler
 ble.irq(ble_handler)
 
 def start_advertising():
     """Start BLE advertising as a discoverable device"""
-    name = b'Gate'  # Device name for pairing
-    
-    # Build advertising data
-    adv_data = bytearray()
-    
-    # Flags - General discoverable mode
-    adv_data += bytes([2, 0x01, 0x06])  # General discoverable, BR/EDR not supported
-    
-    # Complete Local Name
-    adv_data += bytes([len(name) + 1, 0x09]) + name
-    
-    # Service UUID (128-bit)
-    service_bytes = bytes(SERVICE_UUID)
-    adv_data += bytes([len(service_bytes) + 1, 0x07]) + service_bytes
+    name = ADV_NAME.decode()
     
-    print(f"📡 Advertising data: {len(adv_data)} bytes")
+    if _DEBUG:
+        print(f"📡 Advertising data: {len(_ADV_DATA)} bytes")
     
     # Set device name in GAP
     try:
-        ble.config(gap_name=name.decode())
-        print(f"🏷️ GAP name: {name.decode()}")
+        ble.config(gap_name=name)
+        if _DEBUG:
+            print(f"🏷️ GAP name: {name}")
     except Exception as e:
         print(f"⚠️ GAP name error: {e}")
     
-    # Start advertising (100ms interval = discoverable)
-    ble.gap_advertise(100, adv_data)
-    print(f"📡 Advertising as: {name.decode()}")
-    print(f"✅ Device ready for pairing - look for '{name.decode()}' in Bluetooth settings")
+    # Start advertising
+    ble.gap_advertise(_ADV_INTERVAL_US, _ADV_DATA)
+    if _DEBUG:
+        print(f"📡 Advertising as: {name}")
+        print(f"✅ Device ready for pairing - look for '{name}' in Bluetooth settings")
 
 # Start advertising
 start_advertising()
@@ -247,33 +420,40 @@ print("🔗 No password required - just pair and connect")
 print("="*50)
 
 # Main loop
-last_blink_time_ms = 0
-current_blink_interval_ms = 400
+STATUS_INTERVAL_MS = 10_000
 
-try:
+async def status():
+    """Show periodic status every STATUS_INTERVAL_MS, skipping it if nothing changed"""
+    last_status = (None, None)
+    next_status_ms = time.ticks_add(time.ticks_ms(), STATUS_INTERVAL_MS)
+    
     while True:
-        # Use millisecond precision timing
-        current_time_ms = time.ticks_ms()
+        # Sleep to a fixed ticks_ms deadline so the period doesn't drift
+        await asyncio.sleep_ms(max(0, time.ticks_diff(next_status_ms, time.ticks_ms())))
+        next_status_ms = time.ticks_add(next_status_ms, STATUS_INTERVAL_MS)
         
-        # Handle RSSI-based blinking
-        if rssi_blink_active and connected_devices:
-            # Update blink interval based on current RSSI
-            current_blink_interval_ms = rssi_to_blink_interval(current_rssi)
-            
-            # Check if it's time to toggle the LED
-            if time.ticks_diff(current_time_ms, last_blink_time_ms) >= current_blink_interval_ms:
-                update_rssi_blink()
-                last_blink_time_ms = current_time_ms
+        # Retry a drain that couldn't be scheduled - with advertising off,
+        # a stuck disconnect would never be followed by another BLE event
+        if _event_count:
+            _schedule_drain()
         
-        # Show periodic status
-        if int(time.time()) % 10 == 0 and connected_devices:
+        if connected_handles:
+            current_status = (current_rssi, rssi_blink_active)
+            if current_status == last_status:
+                continue
+            last_status = current_status
+            
             if rssi_blink_active:
                 print(f"💚 Status: RSSI {current_rssi} dBm, Blink: {current_blink_interval_ms}ms")
             else:
                 print(f"💙 Status: Connected, RSSI monitoring off")
-        
-        time.sleep_ms(20)  # 20ms sleep for responsive timing
-            
+        else:
+            # Print again on the next connection
+            last_status = (None, None)
+
+try:
+    asyncio.run(status())
+    
 except KeyboardInterrupt:
     print("\n👋 Stopping...")
     stop_rssi_monitoring()